@@ -0,0 +1,59 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from src.smoothing import smooth_fuel_levels
+
+PARAMETERS = ['fuellevel1', 'fuellevel2', 'fuellevel3']
+
+
+def make_window(n_samples, seed=42):
+    rng = np.random.default_rng(seed)
+    levels = 1000 + np.cumsum(rng.normal(0, 2, size=(n_samples, 3)), axis=0)
+    levels[rng.random(levels.shape) < 0.05] = np.nan  # dropped readings
+    levels[rng.random(levels.shape) < 0.02] += 500  # spikes
+    df = pd.DataFrame(levels, columns=PARAMETERS)
+    df.insert(0, 'siteid', 'PH-BUL-00991')
+    return df
+
+
+def pandas_smoothing(df, window_size):
+    # The per-channel groupby/transform chain process_new_data used before the fused kernel
+    out = df.copy()
+    for param in PARAMETERS:
+        out[f'smoothed_{param}'] = out.groupby(['siteid'])[param].transform(lambda x: x.rolling(window=window_size, center=True, min_periods=1).median())
+        out[f'smoothed_{param}'] = out.groupby(['siteid'])[f'smoothed_{param}'].transform(lambda x: x.interpolate(method='linear').ffill().bfill())
+        out[f'smoothed_{param}'] = out.groupby(['siteid'])[f'smoothed_{param}'].transform(lambda x: x.rolling(window=window_size, center=True, min_periods=1).median())
+        out[f'smoothed_{param}'] = out[f'smoothed_{param}'].fillna(out[param])
+    return out[[f'smoothed_{param}' for param in PARAMETERS]].to_numpy()
+
+
+def kernel_smoothing(df, window_size):
+    values = df[PARAMETERS].to_numpy(dtype=np.float64)
+    smoothed = values.copy()
+    for rows in df.groupby('siteid', sort=False).indices.values():
+        smoothed[rows] = smooth_fuel_levels(values[rows], window_size)
+    return smoothed
+
+
+def main(repeats=20):
+    print(f"{'window':>6} {'samples':>8} {'pandas ms':>10} {'kernel ms':>10} {'speedup':>8}")
+    for window_size in (40, 200):
+        for n_samples in (60, 1000, 10000):
+            df = make_window(n_samples)
+            expected = pandas_smoothing(df, window_size)
+            actual = kernel_smoothing(df, window_size)
+            assert np.allclose(expected, actual, equal_nan=True), f"Mismatch at window={window_size} samples={n_samples}"
+
+            pandas_ms = min(timeit.repeat(lambda: pandas_smoothing(df, window_size), number=1, repeat=repeats)) * 1000
+            kernel_ms = min(timeit.repeat(lambda: kernel_smoothing(df, window_size), number=1, repeat=repeats)) * 1000
+            print(f"{window_size:>6} {n_samples:>8} {pandas_ms:>10.2f} {kernel_ms:>10.2f} {pandas_ms / kernel_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
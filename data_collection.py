@@ -5,6 +5,10 @@ import os
 from nats.aio.client import Client as NATSClient
 from src.logs import setup_logging
 from src.utils import decode_message, extract_json_data
+from src.archive import ParquetArchiveWriter
+from src.site_window import SiteWindowBuffer
+from src.jetstream import ACK, RetentionPolicy, ensure_stream, pull_subscribe, consume_batches
+from src.profiling import HandlerProfiler
 
 # Load config
 with open('configs/config.json', 'r') as f:
@@ -12,19 +16,90 @@ with open('configs/config.json', 'r') as f:
 
 # Extract config variables
 MAX_RECENT_DATA = config["max_recent_data"]  # Maximum number of recent data packets to store
+WINDOW_MODE = config.get("window_mode", "count")  # 'count' windows by MAX_RECENT_DATA, 'time' by WINDOW_MINUTES
+WINDOW_MINUTES = config.get("window_minutes", 60)  # Span of a time-based window
 nats_servers = config["nats_servers"]  # NATS server addresses
 processing_subject = config["processing_subject"]  # NATS subject to publish combined data
+archive_config = config.get("archive", {})  # Raw packet archive settings
+jetstream_config = config.get("jetstream", {})  # Optional JetStream delivery settings
+profiling_config = config.get("profiling", {})  # Opt-in handler profiling settings
 
-recent_data = {}  # Global dictionary to store recent data for each siteid
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+recent_data = SiteWindowBuffer(WINDOW_MODE, MAX_RECENT_DATA, WINDOW_MINUTES * 60)  # Sorted, deduplicated window per siteid
 cached_powerstate = {}  # Cache for powerstate from rectifier-1
+archive_writer = None  # Background Parquet writer, started in main() when archiving is enabled
+
+
+def archive_number(value, cast=float):
+    # Malformed values are archived as null rather than failing the packet or the Parquet batch
+    if value is None:
+        return None
+    try:
+        return cast(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def archive_text(value):
+    # String columns of the archive schema; a numeric value would fail the whole Parquet batch
+    return None if value is None else str(value)
+
+
+def archive_packet(siteid, hwcode, gateway, json_data, powerstate=None, fuel_values=None):
+    if archive_writer is None:
+        return
+    # The archive is best-effort: any error here is logged and the live packet carries on
+    try:
+        updatetime = next((item.get('ut') for item in json_data if 'ut' in item), None)
+        fuel_values = fuel_values or {}
+        archive_writer.write({
+            'siteid': archive_text(siteid),
+            'hwcode': archive_text(hwcode),
+            'gateway': archive_text(gateway),
+            'powerstate': archive_text(powerstate),
+            'fuellevel1': archive_number(fuel_values.get('fuellevel1')),
+            'fuellevel2': archive_number(fuel_values.get('fuellevel2')),
+            'fuellevel3': archive_number(fuel_values.get('fuellevel3')),
+            'updatetime': archive_number(updatetime, int)
+        })
+    except Exception as e:
+        logging.error(f"Error archiving packet for siteid {siteid}: {e}")
+
 
 # NATS connection and asyncio loop
 async def main():
+    global archive_writer
+    if archive_config.get("enabled", False):
+        archive_writer = ParquetArchiveWriter(
+            base_dir=os.path.join(current_dir, archive_config.get("path", "archive")),
+            site_buckets=archive_config.get("site_buckets", 16),
+            flush_rows=archive_config.get("flush_rows", 5000),
+            flush_interval=archive_config.get("flush_interval", 30),
+            compression=archive_config.get("compression", "zstd")
+        )
+        archive_writer.start()
+
     nc = NATSClient()
     await nc.connect(servers=nats_servers)
 
     logging.info(f"Connected to NATS servers at {nats_servers}")
 
+    js = None
+    if jetstream_config.get("enabled", False):
+        js = nc.jetstream()
+        # Processing windows are published into a stream so they survive data_processing restarts
+        # Work-queue retention deletes each window once data_processing acks it
+        await ensure_stream(js, jetstream_config.get("stream", "FUEL_PROCESSING"), [processing_subject], jetstream_config.get("max_age"),
+                            jetstream_config.get("max_bytes"), RetentionPolicy.WORK_QUEUE)
+
+    async def publish_window(window):
+        payload = json.dumps(window).encode('utf-8')
+        if js is not None:
+            await js.publish(processing_subject, payload)
+        else:
+            await nc.publish(processing_subject, payload)
+
     async def message_handler(msg):
         try:
             data = decode_message(msg.data)
@@ -56,6 +131,7 @@ async def main():
                         cached_powerstate[siteid] = item.get('vs')
                         logging.info(f"Cached powerstate for siteid: {siteid} - {cached_powerstate[siteid]}")
                         break
+                archive_packet(siteid, hwcode, gateway, json_data, powerstate=cached_powerstate.get(siteid))
 
             if 'env-1' in hwcode:
                 logging.info(f"Received env-1 packet for siteid: {siteid}")
@@ -84,21 +160,15 @@ async def main():
                     if key in env_keys and item.get('v', None) is not None:
                         new_data[key] = max(item['v'], 0)  # Convert negative values to zero
 
-                if siteid not in recent_data:
-                    recent_data[siteid] = []
-
-                if len(recent_data[siteid]) < MAX_RECENT_DATA:
-                    recent_data[siteid].append(new_data)
-                else:
-                    # Find and remove the oldest packet
-                    oldest_packet_index = min(range(len(recent_data[siteid])), key=lambda i: recent_data[siteid][i]['updatetime'])
-                    removed_packet = recent_data[siteid].pop(oldest_packet_index)
-                    logging.info(f"Removed oldest packet with updatetime {removed_packet['updatetime']} for siteid: {siteid}")
-                    recent_data[siteid].append(new_data)
+                archive_packet(siteid, hwcode, gateway, json_data, powerstate=new_data['powerstate'], fuel_values=new_data)
 
-                if len(recent_data[siteid]) == MAX_RECENT_DATA:
-                    logging.info(f"Collected {MAX_RECENT_DATA} packets for siteid: {siteid}")
-                    await nc.publish(processing_subject, json.dumps(recent_data[siteid]).encode('utf-8'))
+                # Windows are kept in updatetime order without duplicates, so they are published ready to process
+                if not new_data['updatetime']:
+                    logging.warning(f"Packet without updatetime for siteid: {siteid}, not added to the window")
+                elif recent_data.add(new_data) and recent_data.is_complete(siteid):
+                    window = recent_data.window(siteid)
+                    logging.info(f"Collected {len(window)} packets for siteid: {siteid}")
+                    await publish_window(window)
 
                 # Print the final output
                 print(f"Final data for siteid {siteid}:")
@@ -108,13 +178,41 @@ async def main():
         except Exception as e:
             logging.error(f"Error processing message: {e}")
 
-    await nc.subscribe("channels.>", cb=message_handler)
-    logging.info(f"Subscribed to 'channels.>'")
-    await asyncio.Future()  # Keep the connection open
-    await nc.close()
+    # Opt-in sampling profiler; toggled by the config's profiling section or SIGUSR1
+    profiler = HandlerProfiler(os.path.join(current_dir, "logs", "data_collection_profiles"), profiling_config)
+    profiler.register_object("recent_data", lambda: recent_data)
+    profiler.register_object("cached_powerstate", lambda: cached_powerstate)
+    profiler.install_signal_handler()
+    asyncio.create_task(profiler.run(os.path.join(current_dir, "configs", "config.json")))
+    message_handler = profiler.wrap(message_handler)
+
+    if js is not None and jetstream_config.get("collect_channels", False):
+        async def jetstream_handler(msg):
+            await message_handler(msg)
+            return ACK
+
+        channels_stream = jetstream_config.get("channels_stream", "CHANNELS")
+        # Interest retention drops raw packets once every consumer on the stream has acked them
+        await ensure_stream(js, channels_stream, ["channels.>"], jetstream_config.get("max_age"),
+                            jetstream_config.get("channels_max_bytes"), RetentionPolicy.INTEREST)
+        psub = await pull_subscribe(js, "channels.>", channels_stream, jetstream_config.get("channels_durable", "fuel_collection"), jetstream_config)
+        asyncio.create_task(consume_batches(
+            psub, jetstream_handler,
+            batch_size=jetstream_config.get("batch_size", 10),
+            fetch_timeout=jetstream_config.get("fetch_timeout", 1),
+            nak_delay=jetstream_config.get("nak_delay")
+        ))
+    else:
+        await nc.subscribe("channels.>", cb=message_handler)
+        logging.info(f"Subscribed to 'channels.>'")
+    try:
+        await asyncio.Future()  # Keep the connection open
+    finally:
+        if archive_writer is not None:
+            archive_writer.close()
+        await nc.close()
 
 if __name__ == '__main__':
-    current_dir = os.path.dirname(os.path.realpath(__file__))
     log_path = os.path.join(current_dir, "logs", "data_collection_logs")
     setup_logging(base_dir=log_path)
 
@@ -3,13 +3,17 @@ import json
 import pandas as pd
 import logging
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from nats.aio.client import Client as NATSClient
 import redis
 from src.logs import setup_logging
 from src.postgresql.db_operations import insert_data_to_table, update_data_in_table, truncate_table, create_table_if_not_exists, remove_siteid_from_table
 from src.postgresql.db_connections import DatabaseConnection
-from src.anomaly_detection import process_new_data
+from src.postgresql.schema_management import manage_partitions, TABLE_SPECS
+from src.process_pool import WindowExecutor, INFRASTRUCTURE_ERRORS
+from src.jetstream import ACK, NAK, TERM, RetentionPolicy, ensure_stream, pull_subscribe, consume_batches
+from src.profiling import HandlerProfiler
 
 # Load configuration
 with open('configs/config.json', 'r') as f:
@@ -26,6 +30,19 @@ results_table_2 = config["results_table_2"]
 results_table_3 = config["results_table_3"]
 results_table_4 = config["results_table_4"]
 redis_config = config["redis_config"]
+jetstream_config = config.get("jetstream", {})
+profiling_config = config.get("profiling", {})
+calibration_config = config.get("calibration", {})
+partition_config = config.get("partitioning", {})
+pool_stats_interval = config.get("pool_stats_interval", 60)  # Seconds between database pool metric logs
+processing_workers = config.get("processing_workers", 0)  # 0 processes windows on the event loop thread
+
+# History tables managed as time-partitioned tables, mapped to their schema spec
+partitioned_tables = {
+    results_table_2: 'alert_history',
+    results_table_4: 'daily_fuel',
+}
+managed_tables = set()  # Tables confirmed partitioned, safe for ON CONFLICT on their primary key
 
 # Setup logging
 current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -36,6 +53,15 @@ setup_logging(base_dir=log_path)
 db_connection = DatabaseConnection(db_config)
 db_connection.connect()
 
+def maintain_partitions():
+    if not partition_config.get("enabled", False):
+        return
+    for table_name, spec_name in partitioned_tables.items():
+        if manage_partitions(table_name, spec_name, db_connection, partition_config):
+            managed_tables.add(table_name)
+
+maintain_partitions()
+
 # Establish Redis connection
 redis_client = redis.Redis(host=redis_config['host'], port=redis_config['port'], db=redis_config['db'])
 
@@ -68,6 +94,12 @@ def remove_data_from_redis(redis_client, redis_key):
     except Exception as e:
         logging.error(f"Error removing data from Redis under key '{redis_key}': {e}")
 
+def history_conflict_columns(table_name):
+    # Only managed tables are guaranteed to carry the unique constraint ON CONFLICT needs
+    if table_name not in managed_tables:
+        return None
+    return TABLE_SPECS[partitioned_tables[table_name]]['primary_key']
+
 def get_last_rows(df):
     return df.groupby('siteid').tail(1)
 
@@ -107,11 +139,13 @@ async def insert_df4_to_db():
             logging.info(f"Inserting aggregated daily DataFrame into {results_table_4}")
 
             if not df4_data.empty:
-                with db_connection.engine.begin() as connection:
+                async with db_connection.begin() as connection:
                     # Insert data for each siteid separately
                     for siteid, group in df4_data.groupby('siteid'):
                         logging.info(f"Inserting data for siteid {siteid}")
-                        insert_data_to_table(group, results_table_4, connection)
+                        # A re-aggregated day replaces the stored totals instead of being skipped
+                        insert_data_to_table(group, results_table_4, connection, conflict_columns=history_conflict_columns(results_table_4),
+                                             conflict_action='update')
                 df4_data = pd.DataFrame()
             else:
                 logging.warning("No valid df4 data to insert after processing.")
@@ -125,18 +159,55 @@ async def main():
     await nc.connect(servers=nats_servers)
     logging.info(f"Connected to NATS servers at {nats_servers}")
 
-    async def message_handler(msg):
-        global df4_data
+    window_executor = WindowExecutor(processing_workers, calibration_config)
+    # Bounds windows queued on the workers; the subscription stops delivering while it is exhausted
+    in_flight = asyncio.Semaphore(max(processing_workers, 1) * 2)
+    pending_tasks = set()
+
+    site_locks = {}  # siteid -> [lock, number of windows holding or waiting for it]
+
+    @asynccontextmanager
+    async def site_order(siteid):
+        # asyncio.Lock wakes waiters first come, first served, so windows of one site are
+        # processed, committed and applied to Redis/df4_data in the order they arrived
+        entry = site_locks.setdefault(siteid, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del site_locks[siteid]
+
+    async def handle_message(msg):
+        # Returns ACK once results are committed, NAK if the database load failed, TERM for windows that can never process
         try:
             data = json.loads(msg.data.decode('utf-8'))
             df = pd.DataFrame(data)
+            siteid = df['siteid'].iloc[0]
+        except Exception as e:
+            logging.error(f"Error in message handler: {e}")
+            return TERM
+
+        # No await before the lock is requested, so requests are queued in delivery order
+        async with site_order(siteid):
+            return await handle_window(df)
+
+    async def handle_window(df):
+        global df4_data
+        try:
             logging.info(f"Received data for processing for siteid {df['siteid'].iloc[0]} and {len(df)} packets")
 
             try:
-                df1, df2, df3, df4 = await process_new_data(df, refill_threshold, theft_threshold)
+                df1, df2, df3, df4 = await window_executor.process(df, refill_threshold, theft_threshold)
+            except INFRASTRUCTURE_ERRORS as e:
+                # Worker or shared-memory failure, not a bad window: let it be redelivered
+                logging.error(f"Error running processing worker: {e}")
+                return NAK
             except Exception as e:
                 logging.error(f"Error processing collected data: {e}")
-                return
+                return TERM
 
             if df2.empty and df3.empty:
                 logging.warning("No events detected")
@@ -144,8 +215,18 @@ async def main():
                 df2 = df2[df2['displaypoint'] != 'normal']
                 df3 = df3[df3['displaypoint'] != 'normal']
 
+            # Redis changes are staged here and applied only once the transaction has committed,
+            # so a rolled-back window leaves Redis untouched and a redelivery repeats the inserts
+            redis_updates = {}  # redis_key -> DataFrame to store, or None to delete
+
+            def current_alarm(redis_key):
+                if redis_key in redis_updates:
+                    pending = redis_updates[redis_key]
+                    return pd.DataFrame() if pending is None else pending
+                return get_data_from_redis(redis_client, redis_key)
+
             try:
-                with db_connection.engine.begin() as connection:
+                async with db_connection.begin() as connection:
                     if not df1.empty:
                         df1 = get_last_rows(df1)
                         logging.info(f"Inserting DataFrame 1 into {results_table_1}")
@@ -159,19 +240,19 @@ async def main():
                             opentime = row['opentime']
                             redis_key = f'results_table_3_{siteid}_{displaypoint}'
                             
-                            previous_alarm = get_data_from_redis(redis_client, redis_key)
+                            previous_alarm = current_alarm(redis_key)
                             
                             if previous_alarm.empty:
-                                send_data_to_redis(pd.DataFrame([row]), redis_client, redis_key)
+                                redis_updates[redis_key] = pd.DataFrame([row])
                                 logging.info(f"Inserting new event into {results_table_2} and Redis for siteid {siteid}")
-                                insert_data_to_table(pd.DataFrame([row]), results_table_2, connection)
+                                insert_data_to_table(pd.DataFrame([row]), results_table_2, connection, conflict_columns=history_conflict_columns(results_table_2))
                             elif not pd.isna(row['closetime']):
                                 existing_event = previous_alarm.iloc[0].copy()
                                 existing_event['closetime'] = row['closetime']
                                 existing_event['end_fuellevel'] = row['end_fuellevel']
                                 update_data_in_table(pd.DataFrame([existing_event]), results_table_2, connection, ['siteid', 'displaypoint', 'opentime'])
                                 logging.info(f"Updating closetime for event: {existing_event}")
-                                remove_data_from_redis(redis_client, redis_key)
+                                redis_updates[redis_key] = None
                             
                     if not df3.empty:
                         for _, row in df3.iterrows():
@@ -179,33 +260,73 @@ async def main():
                             displaypoint = row['displaypoint']
                             redis_key = f'results_table_3_{siteid}_{displaypoint}'
                             
-                            previous_alarm = get_data_from_redis(redis_client, redis_key)
+                            previous_alarm = current_alarm(redis_key)
                             
                             if previous_alarm.empty:
-                                send_data_to_redis(pd.DataFrame([row]), redis_client, redis_key)
+                                redis_updates[redis_key] = pd.DataFrame([row])
                                 logging.info(f"Inserting new event into {results_table_3} and Redis for siteid {siteid}")
                                 insert_data_to_table(pd.DataFrame([row]), results_table_3, connection)
                             elif row['displaypoint'] == 'normal':
-                                remove_data_from_redis(redis_client, redis_key)
-
-                    if not df4.empty:
-                        df4['updatetime'] = pd.to_datetime(df4['updatetime'], unit='s')
-                        if df4_data.empty:
-                            df4_data = df4
-                        else:
-                            df4_data = pd.concat([df4_data, df4])
-                            df4_data = df4_data.drop_duplicates(subset=['siteid', 'updatetime'], keep='last')
+                                redis_updates[redis_key] = None
 
             except Exception as e:
                 logging.error(f"Error loading data to the database: {e}")
-                return
+                return NAK
+
+            # Committed: now publish the alarm state and buffer the daily aggregates
+            for redis_key, alarm in redis_updates.items():
+                if alarm is None:
+                    remove_data_from_redis(redis_client, redis_key)
+                else:
+                    send_data_to_redis(alarm, redis_client, redis_key)
+
+            if not df4.empty:
+                df4['updatetime'] = pd.to_datetime(df4['updatetime'], unit='s')
+                if df4_data.empty:
+                    df4_data = df4
+                else:
+                    df4_data = pd.concat([df4_data, df4])
+                    df4_data = df4_data.drop_duplicates(subset=['siteid', 'updatetime'], keep='last')
 
             logging.info("Data processing completed successfully")
+            return ACK
 
         except Exception as e:
             logging.error(f"Error in message handler: {e}")
+            return TERM
 
-    await nc.subscribe(processing_subject, cb=message_handler)
+    # Opt-in sampling profiler; toggled by the config's profiling section or SIGUSR1
+    profiler = HandlerProfiler(os.path.join(current_dir, "logs", "data_processing_profiles"), profiling_config)
+    profiler.register_object("df4_data", lambda: df4_data)
+    profiler.install_signal_handler()
+    asyncio.create_task(profiler.run(os.path.join(current_dir, "configs", "config.json")))
+    handle_message = profiler.wrap(handle_message)
+
+    async def message_handler(msg):
+        if processing_workers <= 0:
+            await handle_message(msg)
+            return
+        # nats delivers one callback at a time per subscription, so hand windows off as tasks
+        await in_flight.acquire()
+        task = asyncio.create_task(handle_message(msg))
+        pending_tasks.add(task)
+        task.add_done_callback(lambda t: (pending_tasks.discard(t), in_flight.release()))
+
+    if jetstream_config.get("enabled", False):
+        # Durable pull consumer: windows survive restarts and are acked only after the commit
+        js = nc.jetstream()
+        stream = jetstream_config.get("stream", "FUEL_PROCESSING")
+        await ensure_stream(js, stream, [processing_subject], jetstream_config.get("max_age"),
+                            jetstream_config.get("max_bytes"), RetentionPolicy.WORK_QUEUE)
+        psub = await pull_subscribe(js, processing_subject, stream, jetstream_config.get("durable", "fuel_processing"), jetstream_config)
+        asyncio.create_task(consume_batches(
+            psub, handle_message,
+            batch_size=jetstream_config.get("batch_size", 10),
+            fetch_timeout=jetstream_config.get("fetch_timeout", 1),
+            nak_delay=jetstream_config.get("nak_delay")
+        ))
+    else:
+        await nc.subscribe(processing_subject, cb=message_handler)
 
     async def schedule_df4_insert():
         while True:
@@ -220,8 +341,21 @@ async def main():
             except Exception as e:
                 logging.error(f"Error during scheduled df4 insert: {e}")
 
+            try:
+                maintain_partitions()
+            except Exception as e:
+                logging.error(f"Error during scheduled partition maintenance: {e}")
+
     asyncio.create_task(schedule_df4_insert())
 
+    async def report_pool_stats():
+        while True:
+            await asyncio.sleep(pool_stats_interval)
+            logging.info(f"Database pool stats: {db_connection.pool_stats()}")
+
+    if pool_stats_interval:
+        asyncio.create_task(report_pool_stats())
+
     try:
         while True:
             await asyncio.sleep(1)
@@ -229,6 +363,8 @@ async def main():
         pass
 
     await nc.close()
+    window_executor.shutdown()
+    db_connection.close()
 
 if __name__ == '__main__':
     current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import IsolationForest
 import logging
 from datetime import timedelta
+from src.smoothing import smooth_fuel_levels
+from src.calibration import TankCalibration
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -40,8 +43,17 @@ def adjust_timestamps(df, columns, hours):
             df[column] = pd.to_datetime(df[column]) - timedelta(hours=hours)
     return df
 
-async def process_new_data(new_data, refill_threshold, theft_threshold):
+# Used when no calibration is passed: readings are litres, bounded by the default total capacity
+NO_CALIBRATION = TankCalibration()
+
+async def process_new_data(new_data, refill_threshold, theft_threshold, calibration=None):
+    return process_window(new_data, refill_threshold, theft_threshold, calibration)
+
+def process_window(new_data, refill_threshold, theft_threshold, calibration=None):
+    # Synchronous core of process_new_data so it can also run inside worker processes
     logging.info("Processing new data")
+    if calibration is None:
+        calibration = NO_CALIBRATION
     
     fuel_data = new_data[['siteid', 'updatetime', 'gateway', 'hwcode', 'powerstate', 'fuellevel1', 'fuellevel2', 'fuellevel3']].copy()
     logging.debug(f"Filtered data: {fuel_data.head()}")
@@ -51,19 +63,19 @@ async def process_new_data(new_data, refill_threshold, theft_threshold):
     parameters_to_smooth = ['fuellevel1', 'fuellevel2', 'fuellevel3']
     
     window_size = 40  # Adjust this value as needed
-    for param in parameters_to_smooth:
-        # First apply rolling median
-        fuel_data[f'smoothed_{param}'] = fuel_data.groupby(['siteid'])[param].transform(lambda x: x.rolling(window=window_size, center=True, min_periods=1).median())
-        
-        # Then apply interpolation
-        fuel_data[f'smoothed_{param}'] = fuel_data.groupby(['siteid'])[f'smoothed_{param}'].transform(lambda x: x.interpolate(method='linear').fillna(method='ffill').fillna(method='bfill'))
-    
-        # Finally apply rolling median again
-        fuel_data[f'smoothed_{param}'] = fuel_data.groupby(['siteid'])[f'smoothed_{param}'].transform(lambda x: x.rolling(window=window_size, center=True, min_periods=1).median())
+    fuel_values = fuel_data[parameters_to_smooth].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    smoothed_values = fuel_values.copy()
+    tank_capacity = np.full(fuel_values.shape, np.inf)
+    total_capacity = np.full(len(fuel_values), float(calibration.default_total_capacity))
+    for siteid, rows in fuel_data.groupby('siteid', sort=False).indices.items():
+        # Convert sensor readings to litres with the site's strap charts
+        fuel_values[rows], tank_capacity[rows], total_capacity[rows] = calibration.apply(siteid, fuel_values[rows])
+        # Rolling median, interpolation and rolling median again, fused across the three channels
+        smoothed_values[rows] = smooth_fuel_levels(fuel_values[rows], window_size)
+    for i, param in enumerate(parameters_to_smooth):
+        fuel_data[param] = fuel_values[:, i]
+        fuel_data[f'smoothed_{param}'] = smoothed_values[:, i]
 
-        # Fill any remaining NaN values with the original data
-        fuel_data[f'smoothed_{param}'].fillna(fuel_data[param], inplace=True)
-        
     fuel_data['gentotalfuellevel'] = fuel_data[['smoothed_fuellevel1', 'smoothed_fuellevel2', 'smoothed_fuellevel3']].sum(axis=1)
     logging.debug(f"Total smoothed fuel levels calculated: {fuel_data['gentotalfuellevel'].head()}")
 
@@ -84,7 +96,8 @@ async def process_new_data(new_data, refill_threshold, theft_threshold):
     fuel_data['anomaly'] = fuel_data['anomaly'] == -1
     logging.debug(f"Anomalies detected: {fuel_data['anomaly'].sum()}")
 
-    fuel_data['sensor_failure'] = (fuel_data['gentotalfuellevel'] < 0) | (fuel_data['gentotalfuellevel'] > 3000)
+    fuel_data['sensor_failure'] = ((fuel_data['gentotalfuellevel'] < 0) | (fuel_data['gentotalfuellevel'] > total_capacity) |
+                                   (smoothed_values > tank_capacity).any(axis=1))
 
     fuel_data['displaypoint'] = fuel_data.apply(classify_displaypoint, axis=1, args=(refill_threshold, theft_threshold))
     logging.debug(f"Fuel data with displaypoint classification: {fuel_data[['siteid', 'updatetime', 'fuel_diff', 'cumulative_change', 'displaypoint']].head()}")
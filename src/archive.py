@@ -0,0 +1,208 @@
+import os
+import time
+import uuid
+import zlib
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columns are fixed so every partition file shares one schema. siteid and hwcode
+# repeat heavily, so they are dictionary-encoded both in memory and on disk.
+ARCHIVE_SCHEMA = pa.schema([
+    ('siteid', pa.dictionary(pa.int32(), pa.string())),
+    ('hwcode', pa.dictionary(pa.int32(), pa.string())),
+    ('gateway', pa.string()),
+    ('powerstate', pa.string()),
+    ('fuellevel1', pa.float64()),
+    ('fuellevel2', pa.float64()),
+    ('fuellevel3', pa.float64()),
+    ('updatetime', pa.int64()),
+    ('receivedtime', pa.float64()),
+])
+
+DEFAULT_SITE_BUCKETS = 16
+
+_STOP = object()
+
+
+def site_bucket(siteid, site_buckets=DEFAULT_SITE_BUCKETS):
+    # crc32 rather than hash() so buckets are stable across processes and restarts
+    return zlib.crc32(str(siteid).encode('utf-8')) % site_buckets
+
+
+def partition_day(record):
+    timestamp = record.get('updatetime') or record.get('receivedtime') or time.time()
+    return datetime.fromtimestamp(float(timestamp), tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def partition_path(base_dir, day, bucket):
+    return os.path.join(base_dir, f"day={day}", f"site_bucket={bucket:03d}")
+
+
+class ParquetArchiveWriter:
+    """
+    Append-only Parquet archive of parsed telemetry packets, partitioned by day and site bucket.
+    Records are queued from the event loop and written in batches by a background thread.
+    Args:
+    - base_dir: Root directory of the archive
+    - site_buckets: Number of site-hash partitions per day
+    - flush_rows: Number of queued records that triggers a write
+    - flush_interval: Maximum number of seconds records stay buffered
+    - compression: Parquet compression codec
+    - max_queue: Queue bound; records are dropped (and logged) rather than blocking the caller
+    """
+
+    def __init__(self, base_dir, site_buckets=DEFAULT_SITE_BUCKETS, flush_rows=5000, flush_interval=30,
+                 compression='zstd', max_queue=100000):
+        self.base_dir = base_dir
+        self.site_buckets = site_buckets
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self.dropped = 0
+
+    def start(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='parquet-archive-writer', daemon=True)
+        self._thread.start()
+        logging.info(f"Parquet archive writer started at {self.base_dir}")
+
+    def write(self, record):
+        record = dict(record)
+        record.setdefault('receivedtime', time.time())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Archive queue full, dropped packet for siteid {record.get('siteid')} ({self.dropped} dropped so far)")
+
+    def close(self, timeout=None):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.flush_rows or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush(self, records):
+        if not records:
+            return
+        partitions = {}
+        for record in records:
+            key = (partition_day(record), site_bucket(record.get('siteid'), self.site_buckets))
+            partitions.setdefault(key, []).append(record)
+
+        for (day, bucket), rows in partitions.items():
+            try:
+                self._write_partition(day, bucket, rows)
+            except Exception as e:
+                logging.error(f"Error writing {len(rows)} archived packets to partition day={day} site_bucket={bucket}: {e}")
+
+    def _write_partition(self, day, bucket, rows):
+        columns = {name: [row.get(name) for row in rows] for name in ARCHIVE_SCHEMA.names}
+        table = pa.Table.from_pydict(columns, schema=ARCHIVE_SCHEMA)
+
+        directory = partition_path(self.base_dir, day, bucket)
+        os.makedirs(directory, exist_ok=True)
+        file_name = f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(directory, f".{file_name}.tmp")
+
+        # Write to a hidden temp file and rename so readers never see a partial file
+        pq.write_table(table, tmp_path, compression=self.compression, use_dictionary=['siteid', 'hwcode'])
+        os.replace(tmp_path, os.path.join(directory, file_name))
+        logging.debug(f"Archived {len(rows)} packets to {directory}")
+
+
+def _to_epoch(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return pd.Timestamp(value).timestamp()
+
+
+def read_archive(base_dir, start_time=None, end_time=None, siteids=None, columns=None,
+                 site_buckets=DEFAULT_SITE_BUCKETS):
+    """
+    Read archived packets, pruning day and site-bucket partitions before opening any file.
+    Args:
+    - base_dir: Root directory of the archive
+    - start_time: Inclusive lower bound on updatetime (epoch seconds or datetime-like)
+    - end_time: Exclusive upper bound on updatetime (epoch seconds or datetime-like)
+    - siteids: Optional iterable of siteids to keep
+    - columns: Optional list of columns to load
+    - site_buckets: Bucket count the archive was written with
+    """
+    start_epoch = _to_epoch(start_time)
+    end_epoch = _to_epoch(end_time)
+    siteids = set(siteids) if siteids is not None else None
+    buckets = {site_bucket(siteid, site_buckets) for siteid in siteids} if siteids is not None else None
+
+    start_day = datetime.fromtimestamp(start_epoch, tz=timezone.utc).date() if start_epoch is not None else None
+    end_day = datetime.fromtimestamp(end_epoch, tz=timezone.utc).date() if end_epoch is not None else None
+
+    files = []
+    if os.path.isdir(base_dir):
+        for day_dir in sorted(os.listdir(base_dir)):
+            if not day_dir.startswith('day='):
+                continue
+            day = datetime.strptime(day_dir[4:], '%Y-%m-%d').date()
+            if start_day is not None and day < start_day:
+                continue
+            if end_day is not None and day > end_day:
+                continue
+            for bucket_dir in sorted(os.listdir(os.path.join(base_dir, day_dir))):
+                if not bucket_dir.startswith('site_bucket='):
+                    continue
+                if buckets is not None and int(bucket_dir[12:]) not in buckets:
+                    continue
+                directory = os.path.join(base_dir, day_dir, bucket_dir)
+                files.extend(os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith('.parquet'))
+
+    filters = []
+    if start_epoch is not None:
+        filters.append(('updatetime', '>=', int(start_epoch)))
+    if end_epoch is not None:
+        filters.append(('updatetime', '<', int(end_epoch)))
+    if siteids is not None:
+        filters.append(('siteid', 'in', sorted(siteids)))
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(list(columns) + [f[0] for f in filters]))
+
+    tables = [pq.read_table(path, columns=read_columns, filters=filters or None) for path in files]
+    if not tables:
+        empty = ARCHIVE_SCHEMA.empty_table()
+        return empty.select(columns).to_pandas() if columns is not None else empty.to_pandas()
+
+    table = pa.concat_tables(tables)
+    if columns is not None:
+        table = table.select(list(columns))
+    return table.to_pandas()
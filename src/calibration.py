@@ -0,0 +1,114 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+TANKS = 3  # fuellevel1-3
+
+
+def interpolate_litres(readings, xp, fp):
+    # np.interp clamps outside the chart, which would hide over-range sensors, so the
+    # end segments are extended linearly instead
+    litres = np.interp(readings, xp, fp)
+    below = readings < xp[0]
+    above = readings > xp[-1]
+    if below.any():
+        slope = (fp[1] - fp[0]) / (xp[1] - xp[0]) if xp[1] != xp[0] else 0.0
+        litres[below] = fp[0] + (readings[below] - xp[0]) * slope
+    if above.any():
+        slope = (fp[-1] - fp[-2]) / (xp[-1] - xp[-2]) if xp[-1] != xp[-2] else 0.0
+        litres[above] = fp[-1] + (readings[above] - xp[-1]) * slope
+    return litres
+
+
+class TankCalibration:
+    """
+    Per-site, per-tank strap charts packed into flat arrays: `offsets[row, tank]` and
+    `lengths[row, tank]` locate a tank's breakpoints in the concatenated `readings`/`litres`
+    arrays, and `index` maps a siteid to its row.
+    Args:
+    - chart: DataFrame with columns siteid, tank (1-3), reading, litres and optionally capacity
+    - default_total_capacity: Upper bound on total litres for sites without a chart
+    """
+
+    def __init__(self, chart=None, default_total_capacity=3000):
+        self.default_total_capacity = default_total_capacity
+        if chart is None or chart.empty:
+            chart = pd.DataFrame({'siteid': [], 'tank': [], 'reading': [], 'litres': []})
+
+        chart = chart.sort_values(['siteid', 'tank', 'reading'], kind='stable')
+        site_codes, site_names = pd.factorize(chart['siteid'].astype(str), sort=True)
+        tank_index = chart['tank'].to_numpy(dtype=np.int64) - 1
+        if ((tank_index < 0) | (tank_index >= TANKS)).any():
+            raise ValueError(f"Calibration tanks must be between 1 and {TANKS}")
+
+        self.readings = chart['reading'].to_numpy(dtype=np.float64)
+        self.litres = chart['litres'].to_numpy(dtype=np.float64)
+        self.index = {siteid: row for row, siteid in enumerate(site_names)}
+        self.offsets = np.full((len(site_names), TANKS), -1, dtype=np.int64)
+        self.lengths = np.zeros((len(site_names), TANKS), dtype=np.int64)
+        self.capacities = np.full((len(site_names), TANKS), np.inf)
+
+        if len(chart):
+            starts = np.flatnonzero(np.r_[True, (np.diff(site_codes) != 0) | (np.diff(tank_index) != 0)])
+            lengths = np.diff(np.r_[starts, len(chart)])
+            # Tank capacity defaults to the chart's largest volume when not given
+            capacities = np.fmax.reduceat(self.litres, starts)
+            if 'capacity' in chart:
+                listed = np.fmax.reduceat(chart['capacity'].to_numpy(dtype=np.float64), starts)
+                capacities = np.where(np.isnan(listed), capacities, listed)
+
+            usable = lengths >= 2
+            if not usable.all():
+                logging.warning(f"Ignoring {int((~usable).sum())} tank chart(s) with fewer than two breakpoints")
+            rows, tanks = site_codes[starts[usable]], tank_index[starts[usable]]
+            self.offsets[rows, tanks] = starts[usable]
+            self.lengths[rows, tanks] = lengths[usable]
+            self.capacities[rows, tanks] = capacities[usable]
+
+    def apply(self, siteid, values):
+        """
+        Convert one site's raw readings to litres.
+        Returns the litres, the per-tank capacity and the total capacity bound. At a calibrated site,
+        tanks without a chart keep raw readings, bounded per tank by `default_total_capacity`.
+        Args:
+        - siteid: Site the readings belong to
+        - values: Float array of shape (n_samples, 3)
+        """
+        row = self.index.get(siteid)
+        if row is None:
+            return values, np.full(TANKS, np.inf), self.default_total_capacity
+
+        litres = values.copy()
+        for tank in range(TANKS):
+            offset = self.offsets[row, tank]
+            if offset < 0:
+                continue
+            end = offset + self.lengths[row, tank]
+            litres[:, tank] = interpolate_litres(values[:, tank], self.readings[offset:end], self.litres[offset:end])
+        uncalibrated = self.offsets[row] < 0
+        if not uncalibrated.any():
+            # Fully calibrated sites are bounded per tank instead of by the fixed total
+            return litres, self.capacities[row], np.inf
+
+        # Raw channels keep the default bound, on each tank and on top of the calibrated capacities
+        capacities = self.capacities[row].copy()
+        capacities[uncalibrated] = self.default_total_capacity
+        return litres, capacities, capacities[~uncalibrated].sum() + self.default_total_capacity
+
+    def __len__(self):
+        return len(self.index)
+
+
+def load_calibration(path=None, default_total_capacity=3000):
+    if not path:
+        return TankCalibration(default_total_capacity=default_total_capacity)
+    if not os.path.exists(path):
+        logging.warning(f"Calibration table {path} not found, fuel readings are used as litres")
+        return TankCalibration(default_total_capacity=default_total_capacity)
+
+    chart = pd.read_csv(path, dtype={'siteid': str})
+    calibration = TankCalibration(chart, default_total_capacity)
+    logging.info(f"Loaded tank calibration for {len(calibration)} sites from {path}")
+    return calibration
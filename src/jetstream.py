@@ -0,0 +1,89 @@
+import asyncio
+import logging
+
+import nats.errors
+from nats.js.api import StreamConfig, ConsumerConfig, AckPolicy, RetentionPolicy
+from nats.js.errors import NotFoundError
+
+# Outcomes a JetStream message handler returns
+ACK = 'ack'  # Done, including everything committed to Postgres
+NAK = 'nak'  # Failed for a reason that may pass, redeliver after nak_delay
+TERM = 'term'  # Can never succeed, stop redelivering
+
+
+async def ensure_stream(js, name, subjects, max_age=None, max_bytes=None, retention=RetentionPolicy.LIMITS):
+    """
+    Create the stream if it does not exist, or bring an existing stream's size limit in line.
+    Args:
+    - js: JetStream context
+    - name: Stream name
+    - subjects: Subjects the stream captures
+    - max_age: Seconds a message is kept at most
+    - max_bytes: Size cap in bytes; the oldest messages are discarded beyond it
+    - retention: LIMITS keeps messages until a limit is hit, WORK_QUEUE removes each one once it is acked,
+      INTEREST once every consumer has acked it
+    """
+    try:
+        info = await js.stream_info(name)
+    except NotFoundError:
+        await js.add_stream(StreamConfig(name=name, subjects=subjects, retention=retention, max_age=max_age, max_bytes=max_bytes))
+        logging.info(f"Created JetStream stream '{name}' for subjects {subjects} ({retention.value} retention)")
+        return
+
+    config = info.config
+    if config.retention != retention:
+        # Retention cannot be changed on an existing stream
+        logging.warning(f"JetStream stream '{name}' has {config.retention} retention, expected {retention.value}; "
+                        f"delete and recreate it to change it")
+    if max_bytes and config.max_bytes != max_bytes:
+        config.max_bytes = max_bytes
+        await js.update_stream(config=config)
+        logging.info(f"Set max_bytes of JetStream stream '{name}' to {max_bytes}")
+
+
+async def pull_subscribe(js, subject, stream, durable, jetstream_config):
+    consumer_config = ConsumerConfig(
+        durable_name=durable,
+        ack_policy=AckPolicy.EXPLICIT,
+        ack_wait=jetstream_config.get("ack_wait", 60),
+        max_deliver=jetstream_config.get("max_deliver", 5),
+        max_ack_pending=jetstream_config.get("max_ack_pending", 100)
+    )
+    psub = await js.pull_subscribe(subject, durable=durable, stream=stream, config=consumer_config)
+    logging.info(f"Pull consumer '{durable}' bound to '{subject}' on stream '{stream}'")
+    return psub
+
+
+async def consume_batches(psub, handler, batch_size=10, fetch_timeout=1, nak_delay=None):
+    """
+    Fetch messages in batches, run the handler on each concurrently and acknowledge by outcome.
+    Args:
+    - psub: Pull subscription from pull_subscribe
+    - handler: Coroutine function taking a message and returning ACK, NAK or TERM
+    - batch_size: Maximum messages per fetch
+    - fetch_timeout: Seconds to wait for a batch before polling again
+    - nak_delay: Seconds before a NAK'd message is redelivered
+    """
+    while True:
+        try:
+            msgs = await psub.fetch(batch_size, timeout=fetch_timeout)
+        except nats.errors.TimeoutError:
+            continue
+        except Exception as e:
+            logging.error(f"Error fetching JetStream batch: {e}")
+            await asyncio.sleep(fetch_timeout)
+            continue
+
+        outcomes = await asyncio.gather(*(handler(msg) for msg in msgs), return_exceptions=True)
+        for msg, outcome in zip(msgs, outcomes):
+            try:
+                if outcome == ACK:
+                    await msg.ack()
+                elif outcome == TERM:
+                    await msg.term()
+                else:
+                    if isinstance(outcome, Exception):
+                        logging.error(f"Unhandled error in JetStream handler: {outcome}")
+                    await msg.nak(delay=nak_delay)
+            except Exception as e:
+                logging.error(f"Error acknowledging JetStream message: {e}")
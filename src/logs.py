@@ -32,15 +32,16 @@ class CustomFormatter(logging.Formatter):
         return formatter.format(record)
 
 
-def cleanup_old_logs(log_directory, max_files=10):
+def cleanup_old_logs(log_directory, max_files=10, suffix='.log'):
     """
     Remove old log files, keeping only the most recent `max_files` log files.
     Args:
     - log_directory: Directory where log files are stored
     - max_files: Maximum number of recent log files to keep
+    - suffix: File extension of the files to rotate
     """
     log_files = sorted(
-        (os.path.join(log_directory, f) for f in os.listdir(log_directory) if f.endswith('.log')),
+        (os.path.join(log_directory, f) for f in os.listdir(log_directory) if f.endswith(suffix)),
         key=os.path.getmtime,
         reverse=True
     )
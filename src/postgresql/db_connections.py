@@ -1,34 +1,110 @@
-import psycopg2
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError, DisconnectionError, TimeoutError as PoolTimeoutError
+
+RETRYABLE_ERRORS = (OperationalError, DisconnectionError, PoolTimeoutError)
 
 
 class DatabaseConnection:
     def __init__(self, db_config):
         self.db_config = db_config
         self.engine = None
-        self.pg_connection = None
+        self.retries = db_config.get("connect_retries", 5)
+        self.retry_backoff = db_config.get("retry_backoff", 1)
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.reconnects = 0
+
+    def create_engine(self):
+        engine = create_engine(
+            f"postgresql+psycopg2://{self.db_config['user']}:{self.db_config['password']}@"
+            f"{self.db_config['host']}:{self.db_config['port']}/{self.db_config['dbname']}",
+            pool_size=self.db_config.get("pool_size", 5),
+            max_overflow=self.db_config.get("max_overflow", 10),
+            pool_timeout=self.db_config.get("pool_timeout", 30),
+            pool_recycle=self.db_config.get("pool_recycle", 1800),
+            pool_pre_ping=self.db_config.get("pool_pre_ping", True),
+            # psycopg2 never uses server-side prepared statements, and no session-level
+            # startup options are sent, so connections work behind pgbouncer transaction pooling
+            connect_args={"connect_timeout": self.db_config.get("connect_timeout", 10)}
+        )
+
+        statement_timeout_ms = self.db_config.get("statement_timeout_ms")
+        if statement_timeout_ms:
+            @event.listens_for(engine, "begin")
+            def set_statement_timeout(conn):
+                # SET LOCAL only lasts for the transaction, so it never leaks to another pgbouncer client
+                conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+
+        return engine
 
     def connect(self):
+        for attempt in range(self.retries + 1):
+            try:
+                self.engine = self.create_engine()
+                with self.engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                return
+            except RETRYABLE_ERRORS as e:
+                if self.engine:
+                    self.engine.dispose()
+                if attempt == self.retries:
+                    logging.error(f"Failed to connect to the database: {e}")
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logging.warning(f"Database connection attempt {attempt + 1} failed, retrying in {delay}s: {e}")
+                time.sleep(delay)
+
+    @asynccontextmanager
+    async def begin(self):
+        # Async counterpart of engine.begin(): checkout (which may wait up to pool_timeout or
+        # run a pre-ping) happens on a thread and retries back off with asyncio.sleep, so the
+        # event loop keeps serving NATS while the database is unreachable
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                conn = await loop.run_in_executor(None, self.engine.connect)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.retries:
+                    logging.error(f"Failed to acquire a database connection: {e}")
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logging.warning(f"Database connection lost, reconnecting in {delay}s: {e}")
+                self.reconnects += 1
+                await asyncio.sleep(delay)
+                continue
+
+            waited = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            break
+
         try:
-            self.engine = create_engine(
-                f"postgresql+psycopg2://{self.db_config['user']}:{self.db_config['password']}@"
-                f"{self.db_config['host']}:{self.db_config['port']}/{self.db_config['dbname']}"
-            )
-            self.pg_connection = psycopg2.connect(
-                user=self.db_config["user"],
-                password=self.db_config["password"],
-                host=self.db_config["host"],
-                port=self.db_config["port"],
-                database=self.db_config["dbname"]
-            )
-            self.pg_connection.autocommit = True
-        except Exception as e:
-            print(f"Failed to connect to the database: {e}")
-            raise
+            with conn.begin():
+                yield conn
+        finally:
+            conn.close()
+
+    def pool_stats(self):
+        pool = self.engine.pool
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "checkouts": self.checkouts,
+            "wait_time_avg_ms": round(1000 * self.wait_time_total / self.checkouts, 2) if self.checkouts else 0.0,
+            "wait_time_max_ms": round(1000 * self.wait_time_max, 2),
+            "reconnects": self.reconnects
+        }
 
     def close(self):
         if self.engine:
             self.engine.dispose()
-        if self.pg_connection:
-            self.pg_connection.close()
\ No newline at end of file
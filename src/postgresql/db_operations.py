@@ -1,95 +1,172 @@
 import pandas as pd
+from contextlib import contextmanager
+from sqlalchemy.engine import Connection
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import inspect, MetaData, Table, text, insert
+from sqlalchemy import inspect, MetaData, Table, text, insert, select
+from sqlalchemy import types as sqltypes
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import logging
 
-def read_sql_table(table_name, db_connection):
-    query = f"SELECT * FROM {table_name};"
-    df = pd.read_sql(query, db_connection.engine)
-    return df
-
-def add_new_columns(df, table_name, db_connection):
-    engine = db_connection.engine
-    connection = engine.connect()
-    inspector = inspect(engine)
-    
-    existing_columns = inspector.get_columns(table_name)
-    existing_column_names = [col['name'] for col in existing_columns]
-
-    new_columns = [col for col in df.columns if col not in existing_column_names]
-
-    if new_columns:
-        for col in new_columns:
-            col_type = str(df[col].dtype)
-            if 'int' in col_type:
-                col_type = 'INTEGER'
-            elif 'float' in col_type:
-                col_type = 'FLOAT'
-            elif 'datetime' in col_type:
-                col_type = 'TIMESTAMP'
-            else:
-                col_type = 'VARCHAR'
-            
-            with engine.begin() as conn:
-                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {col} {col_type}"))
-        logging.info(f"New columns {new_columns} added to table '{table_name}'.")
-
-    connection.close()
-
-def create_table_if_not_exists(df, table_name, db_connection):
-    engine = db_connection.engine
-    inspector = inspect(engine)
-
-    if not inspector.has_table(table_name):
-        df.head(0).to_sql(table_name, con=engine, if_exists='replace', index=False)
-        logging.info(f"Table '{table_name}' created successfully.")
-
-def insert_data_to_table(df, table_name, db_connection):
-    create_table_if_not_exists(df, table_name, db_connection)
-    
+def arrow_field(column):
+    # Arrow type and value converter for a reflected column. Types come from the table, not from each
+    # chunk's values, so every batch of one read shares a schema even when a chunk is all nulls.
+    import pyarrow as pa
+    sql_type = column.type
+    if isinstance(sql_type, sqltypes.Boolean):
+        return pa.bool_(), None
+    if isinstance(sql_type, sqltypes.Integer):
+        return pa.int64(), None
+    if isinstance(sql_type, sqltypes.Float):
+        return pa.float64(), None
+    if isinstance(sql_type, sqltypes.Numeric):
+        if sql_type.precision:
+            return pa.decimal128(sql_type.precision, sql_type.scale or 0), None
+        return pa.float64(), float  # Unconstrained NUMERIC has no fixed scale
+    if isinstance(sql_type, sqltypes.DateTime):
+        return pa.timestamp('us', tz='UTC' if sql_type.timezone else None), None
+    if isinstance(sql_type, sqltypes.Date):
+        return pa.date32(), None
+    if isinstance(sql_type, sqltypes.Time):
+        return pa.time64('us'), None
+    if isinstance(sql_type, sqltypes.LargeBinary):
+        return pa.binary(), None
+    # Strings, and anything without a direct Arrow type (JSON, UUID, ...) as text
+    return pa.string(), (None if isinstance(sql_type, sqltypes.String) else str)
+
+def read_sql_chunks(table_name, db_connection, columns=None, siteids=None, start_time=None, end_time=None,
+                    time_column='updatetime', chunksize=50000, as_arrow=False):
+    """
+    Stream rows of a table as DataFrame chunks (or Arrow record batches) through a server-side cursor.
+    Args:
+    - table_name: Table to read
+    - db_connection: Object exposing a SQLAlchemy `engine`
+    - columns: Optional list of columns to select, defaults to all columns
+    - siteids: Optional iterable of siteids to keep
+    - start_time: Optional inclusive lower bound on `time_column`
+    - end_time: Optional exclusive upper bound on `time_column`
+    - time_column: Column the time bounds apply to
+    - chunksize: Number of rows per chunk
+    - as_arrow: Yield pyarrow.RecordBatch objects instead of DataFrames
+    """
     engine = db_connection.engine
     metadata = MetaData()
-    metadata.bind = engine
     table = Table(table_name, metadata, autoload_with=engine)
 
-    add_new_columns(df, table_name, db_connection)
-
-    records = df.to_dict(orient='records')
+    selected = [table.c[col] for col in columns] if columns else list(table.columns)
+    stmt = select(*selected)
+    # Predicates go through bound parameters; identifiers are validated by reflection above
+    if siteids is not None:
+        stmt = stmt.where(table.c['siteid'].in_(list(siteids)))
+    if start_time is not None:
+        stmt = stmt.where(table.c[time_column] >= start_time)
+    if end_time is not None:
+        stmt = stmt.where(table.c[time_column] < end_time)
+
+    if as_arrow:
+        import pyarrow as pa
+        fields = [arrow_field(col) for col in selected]
+        schema = pa.schema([(col.name, arrow_type) for col, (arrow_type, _) in zip(selected, fields)])
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunksize).execute(stmt)
+        keys = list(result.keys())
+        for rows in result.partitions(chunksize):
+            if as_arrow:
+                # Columns go straight from the fetched rows into Arrow, without a pandas copy in between
+                arrays = [
+                    pa.array(values if convert is None else [None if v is None else convert(v) for v in values], type=arrow_type)
+                    for values, (arrow_type, convert) in zip(zip(*rows), fields)
+                ]
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+            else:
+                yield pd.DataFrame.from_records(rows, columns=keys)
+
+def read_sql_table(table_name, db_connection, columns=None, siteids=None, start_time=None, end_time=None,
+                   time_column='updatetime', chunksize=50000):
+    chunks = list(read_sql_chunks(table_name, db_connection, columns, siteids, start_time, end_time, time_column, chunksize))
+    if not chunks:
+        # Keep the schema of an empty result: the requested columns, or all of the table's
+        if not columns:
+            columns = [col['name'] for col in inspect(db_connection.engine).get_columns(table_name)]
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+@contextmanager
+def transaction_scope(db_connection):
+    # A Connection passed in by the caller is used as-is so every write joins its transaction;
+    # anything else (DatabaseConnection, engine holder) gets a transaction of its own
+    if isinstance(db_connection, Connection):
+        yield db_connection
+    else:
+        with db_connection.engine.begin() as conn:
+            yield conn
 
-    with engine.begin() as conn:
-        for record in records:
-            stmt = table.insert().values(record)
-            try:
-                conn.execute(stmt)
-            except SQLAlchemyError as e:
-                logging.error(f"Error occurred during data insert to '{table_name}': {e}")
-                continue
+def add_new_columns(df, table_name, db_connection):
+    with transaction_scope(db_connection) as conn:
+        existing_columns = inspect(conn).get_columns(table_name)
+        existing_column_names = [col['name'] for col in existing_columns]
+
+        new_columns = [col for col in df.columns if col not in existing_column_names]
+
+        if new_columns:
+            for col in new_columns:
+                col_type = str(df[col].dtype)
+                if 'int' in col_type:
+                    col_type = 'INTEGER'
+                elif 'float' in col_type:
+                    col_type = 'FLOAT'
+                elif 'datetime' in col_type:
+                    col_type = 'TIMESTAMP'
+                else:
+                    col_type = 'VARCHAR'
 
-def update_data_in_table(df, table_name, db_connection, unique_columns=['siteid', 'updatetime']):
-    engine = db_connection.engine
-    metadata = MetaData()
-    metadata.bind = engine
-    table = Table(table_name, metadata, autoload_with=engine)
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {col} {col_type}"))
+            logging.info(f"New columns {new_columns} added to table '{table_name}'.")
 
-    records = df.to_dict(orient='records')
+def create_table_if_not_exists(df, table_name, db_connection):
+    with transaction_scope(db_connection) as conn:
+        if not inspect(conn).has_table(table_name):
+            df.head(0).to_sql(table_name, con=conn, if_exists='replace', index=False)
+            logging.info(f"Table '{table_name}' created successfully.")
+
+def insert_data_to_table(df, table_name, db_connection, conflict_columns=None, conflict_action='nothing'):
+    # Errors propagate to the caller: a failed statement aborts the whole Postgres transaction anyway
+    if conflict_action not in ('nothing', 'update'):
+        raise ValueError(f"Unknown conflict action '{conflict_action}', expected 'nothing' or 'update'")
+    if df.empty:
+        return
+    with transaction_scope(db_connection) as conn:
+        create_table_if_not_exists(df, table_name, conn)
+        add_new_columns(df, table_name, conn)
+
+        table = Table(table_name, MetaData(), autoload_with=conn)
+        stmt = table.insert()
+        if conflict_columns:
+            stmt = pg_insert(table)
+            updated = [col for col in df.columns if col not in conflict_columns]
+            if conflict_action == 'update' and updated:
+                # Rows already present under the table's unique constraint take the new values
+                stmt = stmt.on_conflict_do_update(index_elements=conflict_columns,
+                                                  set_={col: stmt.excluded[col] for col in updated})
+            else:
+                # Skip rows already present under the table's unique constraint
+                stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+        conn.execute(stmt, df.to_dict(orient='records'))
 
-    with engine.begin() as conn:
-        for record in records:
+def update_data_in_table(df, table_name, db_connection, unique_columns=['siteid', 'updatetime']):
+    with transaction_scope(db_connection) as conn:
+        table = Table(table_name, MetaData(), autoload_with=conn)
+        for record in df.to_dict(orient='records'):
             conditions = [table.c[col] == record[col] for col in unique_columns]
-            stmt = table.update().where(*conditions).values(record)
-            try:
-                conn.execute(stmt)
-            except SQLAlchemyError as e:
-                logging.error(f"Error occurred during data update to '{table_name}': {e}")
-                continue
+            conn.execute(table.update().where(*conditions).values(record))
 
 def truncate_table(table_name, db_connection):
-    engine = db_connection.engine
-    inspector = inspect(engine)
-    
-    if inspector.has_table(table_name):
+    with transaction_scope(db_connection) as conn:
+        exists = inspect(conn).has_table(table_name)
+
+    if exists:
         try:
-            with engine.begin() as conn:
+            with transaction_scope(db_connection) as conn:
                 conn.execute(text(f"TRUNCATE TABLE {table_name}"))
             logging.info(f"Table '{table_name}' has been truncated successfully.")
         except SQLAlchemyError as e:
@@ -98,27 +175,22 @@ def truncate_table(table_name, db_connection):
         logging.warning(f"Table '{table_name}' does not exist and cannot be truncated.")
 
 def remove_siteid_from_table(siteid, table_name, db_connection):
-    engine = db_connection.engine
     try:
-        with engine.begin() as conn:
+        with transaction_scope(db_connection) as conn:
             conn.execute(text(f"DELETE FROM {table_name} WHERE siteid = :siteid"), {'siteid': siteid})
         logging.info(f"Entries for siteid '{siteid}' have been removed from table '{table_name}'.")
     except SQLAlchemyError as e:
         logging.error(f"Error removing siteid '{siteid}' from table '{table_name}': {e}")
 
 def manage_site_wise_alarm(df, site_wise_alarm, current_time, db_connection):
-    engine = db_connection.engine
-    metadata = MetaData()
-    metadata.bind = engine
-    table = Table(site_wise_alarm, metadata, autoload_with=engine)
-    
     df['inserted_at'] = current_time
 
     add_new_columns(df, site_wise_alarm, db_connection)
 
     records = df.to_dict(orient='records')
 
-    with engine.begin() as conn:
+    with transaction_scope(db_connection) as conn:
+        table = Table(site_wise_alarm, MetaData(), autoload_with=conn)
         for record in records:
             stmt = insert(table).values(record)
             try:
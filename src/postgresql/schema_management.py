@@ -0,0 +1,275 @@
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+# Explicit schemas for the append-heavy history tables. Both are range-partitioned by
+# month on their time column; Postgres requires the partition column in every unique
+# constraint, so it is part of each primary key.
+TABLE_SPECS = {
+    'alert_history': {
+        'columns': [
+            ('siteid', 'VARCHAR NOT NULL'),
+            ('gateway', 'VARCHAR'),
+            ('hwcode', 'VARCHAR'),
+            ('displaypoint', 'VARCHAR NOT NULL'),
+            ('opentime', 'TIMESTAMP NOT NULL'),
+            ('closetime', 'TIMESTAMP'),
+            ('start_fuellevel', 'DOUBLE PRECISION'),
+            ('end_fuellevel', 'DOUBLE PRECISION'),
+            ('severity', 'VARCHAR'),
+            ('time', 'DOUBLE PRECISION'),
+            ('type', 'VARCHAR'),
+            ('protocol', 'VARCHAR'),
+        ],
+        'partition_column': 'opentime',
+        'partition_type': 'timestamp',
+        'primary_key': ['siteid', 'displaypoint', 'opentime'],
+        'indexes': [['siteid', 'opentime']],
+    },
+    'daily_fuel': {
+        'columns': [
+            ('siteid', 'VARCHAR NOT NULL'),
+            ('consumption_litre', 'DOUBLE PRECISION'),
+            ('refill_litre', 'DOUBLE PRECISION'),
+            ('theft_litre', 'DOUBLE PRECISION'),
+            ('day', 'BIGINT'),
+            ('day_start_fuellevel', 'DOUBLE PRECISION'),
+            ('day_end_fuellevel', 'DOUBLE PRECISION'),
+            ('updatetime', 'BIGINT NOT NULL'),
+            ('time', 'DOUBLE PRECISION'),
+        ],
+        'partition_column': 'updatetime',
+        'partition_type': 'epoch',
+        'primary_key': ['siteid', 'updatetime'],
+        'indexes': [],
+    },
+}
+
+
+def add_months(year, month, months):
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def partition_name(table_name, year, month):
+    return f"{table_name}_p{year:04d}{month:02d}"
+
+
+def partition_bound(spec, year, month):
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    if spec['partition_type'] == 'epoch':
+        return str(int(start.timestamp()))
+    return f"'{start.strftime('%Y-%m-%d %H:%M:%S')}'"
+
+
+def is_partitioned_table(table_name, connection):
+    relkind = connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)"),
+        {'table_name': table_name}
+    ).scalar()
+    if relkind is None:
+        return None
+    return relkind == 'p'
+
+
+def index_name(table_name, index_columns):
+    return f"{table_name}_{'_'.join(index_columns)}_idx"
+
+
+def partition_ddl(table_name, spec, year, month):
+    next_year, next_month = add_months(year, month, 1)
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(table_name, year, month)} PARTITION OF {table_name} "
+            f"FOR VALUES FROM ({partition_bound(spec, year, month)}) TO ({partition_bound(spec, next_year, next_month)})")
+
+
+def partition_month(spec, value):
+    if spec['partition_type'] == 'epoch':
+        value = datetime.fromtimestamp(value, timezone.utc)
+    return value.year, value.month
+
+
+def table_columns(table_name, connection):
+    return set(connection.execute(
+        text("SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(:table_name) AND attnum > 0 AND NOT attisdropped"),
+        {'table_name': table_name}
+    ).scalars())
+
+
+def create_table_from_spec(table_name, spec, conn):
+    columns = ", ".join(f"{name} {col_type}" for name, col_type in spec['columns'])
+    primary_key = ", ".join(spec['primary_key'])
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}, PRIMARY KEY ({primary_key})) "
+        f"PARTITION BY RANGE ({spec['partition_column']})"
+    ))
+    # Catches rows outside every monthly partition instead of failing the insert
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT"))
+
+    for index_columns in spec['indexes']:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name(table_name, index_columns)} ON {table_name} ({', '.join(index_columns)})"))
+
+
+def index_unpartitioned_table(table_name, spec, conn):
+    # Tables created by to_sql have no keys; index the primary key and lookup columns so
+    # update_data_in_table and per-site reads avoid sequential scans
+    present = table_columns(table_name, conn)
+    for index_columns in [spec['primary_key']] + spec['indexes']:
+        missing = [col for col in index_columns if col not in present]
+        if missing:
+            logging.warning(f"Table '{table_name}' has no column(s) {missing}; skipping index on {index_columns}")
+            continue
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name(table_name, index_columns)} ON {table_name} ({', '.join(index_columns)})"))
+
+
+def migrate_to_partitioned(table_name, spec, conn, partition_config, now=None):
+    """
+    Replace an unpartitioned table with the partitioned layout in the caller's transaction.
+    The old table is kept as `<table>_legacy`; rows with a null key, and duplicates of the
+    primary key, are not copied.
+    Args:
+    - table_name: Existing unpartitioned table
+    - spec: Entry of TABLE_SPECS for the table
+    - conn: Connection with an open transaction
+    - partition_config: The `partitioning` section of the config
+    """
+    now = now or datetime.now(timezone.utc)
+    legacy_name = f"{table_name}_legacy"
+    partition_column = spec['partition_column']
+    present = table_columns(table_name, conn)
+    if partition_column not in present:
+        raise ValueError(f"Table '{table_name}' has no '{partition_column}' column to partition on")
+
+    conn.execute(text(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text(f"ALTER TABLE {table_name} RENAME TO {legacy_name}"))
+    # Free the index names for the new table
+    for index_columns in [spec['primary_key']] + spec['indexes']:
+        conn.execute(text(f"ALTER INDEX IF EXISTS {index_name(table_name, index_columns)} RENAME TO {index_name(legacy_name, index_columns)}"))
+    create_table_from_spec(table_name, spec, conn)
+
+    types = {name: col_type.replace(' NOT NULL', '') for name, col_type in spec['columns']}
+    lowest, highest = conn.execute(text(
+        f"SELECT min(CAST({partition_column} AS {types[partition_column]})), "
+        f"max(CAST({partition_column} AS {types[partition_column]})) FROM {legacy_name}"
+    )).one()
+    if lowest is not None:
+        # Monthly partitions for the existing rows, bounded by the retention window and the
+        # months created ahead, so stray timestamps end up in the default partition
+        first, last = partition_month(spec, lowest), partition_month(spec, highest)
+        retention_months = partition_config.get('retention_months')
+        if retention_months:
+            first = max(first, add_months(now.year, now.month, -retention_months))
+        last = min(last, add_months(now.year, now.month, partition_config.get('months_ahead', 3)))
+        year, month = first
+        while (year, month) <= last:
+            conn.execute(text(partition_ddl(table_name, spec, year, month)))
+            year, month = add_months(year, month, 1)
+
+    dropped = sorted(present - set(types))
+    if dropped:
+        logging.warning(f"Column(s) {dropped} of '{table_name}' are not in the partitioned schema; they remain in '{legacy_name}'")
+    names = ", ".join(types)
+    selected = ", ".join(f"CAST({name} AS {col_type})" if name in present else f"CAST(NULL AS {col_type})"
+                         for name, col_type in types.items())
+    key_present = " AND ".join(f"{col} IS NOT NULL" for col in spec['primary_key'])
+    copied = conn.execute(text(
+        f"INSERT INTO {table_name} ({names}) SELECT {selected} FROM {legacy_name} WHERE {key_present} "
+        f"ON CONFLICT DO NOTHING"
+    )).rowcount
+    logging.info(f"Migrated {copied} rows of '{table_name}' into a partitioned table; the original is kept as '{legacy_name}'.")
+
+
+def create_partitioned_table(table_name, spec_name, db_connection, partition_config=None):
+    spec = TABLE_SPECS[spec_name]
+    partition_config = partition_config or {}
+    engine = db_connection.engine
+
+    with engine.begin() as conn:
+        partitioned = is_partitioned_table(table_name, conn)
+        if partitioned is False:
+            if not partition_config.get('migrate_existing', False):
+                index_unpartitioned_table(table_name, spec, conn)
+                logging.warning(f"Table '{table_name}' exists but is not partitioned; indexed its key columns and left it unmanaged. "
+                                f"Set partitioning.migrate_existing to migrate it.")
+                return False
+            migrate_to_partitioned(table_name, spec, conn, partition_config)
+        else:
+            create_table_from_spec(table_name, spec, conn)
+
+    if partitioned is None:
+        logging.info(f"Partitioned table '{table_name}' created successfully.")
+    return True
+
+
+def ensure_future_partitions(table_name, spec_name, db_connection, months_ahead=3, now=None):
+    spec = TABLE_SPECS[spec_name]
+    now = now or datetime.now(timezone.utc)
+    engine = db_connection.engine
+
+    for offset in range(months_ahead + 1):
+        year, month = add_months(now.year, now.month, offset)
+        name = partition_name(table_name, year, month)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(partition_ddl(table_name, spec, year, month)))
+        except SQLAlchemyError as e:
+            # Usually means the default partition already holds rows for this month
+            logging.error(f"Error creating partition '{name}' of '{table_name}': {e}")
+
+
+def list_partitions(table_name, db_connection):
+    with db_connection.engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+            "WHERE parent.oid = to_regclass(:table_name)"
+        ), {'table_name': table_name}).scalars().all()
+
+    partitions = []
+    prefix = f"{table_name}_p"
+    for name in rows:
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            partitions.append((int(suffix[:4]), int(suffix[4:]), name))
+    return sorted(partitions)
+
+
+def apply_retention(table_name, db_connection, retention_months, action='detach', now=None):
+    if not retention_months:
+        return []
+    if action not in ('detach', 'drop'):
+        raise ValueError(f"Unknown retention action '{action}', expected 'detach' or 'drop'")
+
+    now = now or datetime.now(timezone.utc)
+    cutoff = add_months(now.year, now.month, -retention_months)
+    removed = []
+
+    for year, month, name in list_partitions(table_name, db_connection):
+        if (year, month) >= cutoff:
+            continue
+        try:
+            with db_connection.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table_name} DETACH PARTITION {name}"))
+                if action == 'drop':
+                    conn.execute(text(f"DROP TABLE {name}"))
+            removed.append(name)
+            logging.info(f"Partition '{name}' of '{table_name}' {'dropped' if action == 'drop' else 'detached'} by retention policy.")
+        except SQLAlchemyError as e:
+            logging.error(f"Error applying retention to partition '{name}' of '{table_name}': {e}")
+    return removed
+
+
+def manage_partitions(table_name, spec_name, db_connection, partition_config):
+    # Returns True when the table is partitioned and carries the spec's constraints
+    try:
+        if not create_partitioned_table(table_name, spec_name, db_connection, partition_config):
+            return False
+        ensure_future_partitions(table_name, spec_name, db_connection, partition_config.get('months_ahead', 3))
+        apply_retention(table_name, db_connection, partition_config.get('retention_months'),
+                        partition_config.get('retention_action', 'detach'))
+        return True
+    except (SQLAlchemyError, ValueError) as e:
+        logging.error(f"Error managing partitions for '{table_name}': {e}")
+        return False
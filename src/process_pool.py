@@ -0,0 +1,147 @@
+import zlib
+import asyncio
+import logging
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from src.anomaly_detection import process_new_data, process_window
+from src.calibration import load_calibration
+
+# Every per-packet field of a window is packed into one float64 block in shared memory:
+# numeric columns as-is, string columns as factorized codes (-1 for missing).
+NUMERIC_COLUMNS = ['updatetime', 'fuellevel1', 'fuellevel2', 'fuellevel3']
+LABEL_COLUMNS = ['siteid', 'gateway', 'hwcode', 'powerstate']
+
+worker_calibration = None  # Loaded once per worker process by init_worker
+
+# Failures of the execution backend rather than of the window itself; worth retrying elsewhere or later
+INFRASTRUCTURE_ERRORS = (BrokenProcessPool, OSError)
+
+
+def pack_window(df):
+    block = np.empty((len(df), len(NUMERIC_COLUMNS) + len(LABEL_COLUMNS)), dtype=np.float64)
+    for i, col in enumerate(NUMERIC_COLUMNS):
+        block[:, i] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+    categories = {}
+    for i, col in enumerate(LABEL_COLUMNS, start=len(NUMERIC_COLUMNS)):
+        codes, uniques = pd.factorize(df[col])
+        block[:, i] = codes
+        categories[col] = list(uniques)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(block.nbytes, 1))
+    shared = np.ndarray(block.shape, dtype=block.dtype, buffer=shm.buf)
+    shared[:] = block
+    return shm, (shm.name, block.shape, categories)
+
+
+def unpack_window(descriptor):
+    shm_name, shape, categories = descriptor
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+    data = {}
+    for i, col in enumerate(LABEL_COLUMNS, start=len(NUMERIC_COLUMNS)):
+        labels = np.array(categories[col] + [None], dtype=object)
+        # code -1 indexes the trailing None
+        data[col] = labels[block[:, i].astype(np.int64)]
+    for i, col in enumerate(NUMERIC_COLUMNS):
+        data[col] = block[:, i]
+
+    updatetime = data['updatetime']
+    if not np.isnan(updatetime).any() and np.array_equal(updatetime, np.floor(updatetime)):
+        data['updatetime'] = updatetime.astype(np.int64)
+    return pd.DataFrame(data)
+
+
+def pack_frame(df):
+    # Column name/array pairs pickle much smaller than a DataFrame with its index and block manager
+    return list(df.columns), [df[col].to_numpy() for col in df.columns]
+
+
+def unpack_frame(packed):
+    columns, arrays = packed
+    return pd.DataFrame(dict(zip(columns, arrays)), columns=columns)
+
+
+def init_worker(calibration_config):
+    global worker_calibration
+    worker_calibration = load_calibration(calibration_config.get("path"), calibration_config.get("default_total_capacity", 3000))
+
+
+def run_window(descriptor, refill_threshold, theft_threshold):
+    df = unpack_window(descriptor)
+    results = process_window(df, refill_threshold, theft_threshold, worker_calibration)
+    return [pack_frame(result) for result in results]
+
+
+class WindowExecutor:
+    """
+    Runs process_new_data for site windows either in-process or on worker processes.
+    Each worker is a single-process pool and windows are routed by siteid hash, so a site
+    always lands on the same worker and any per-site state there stays warm.
+    Args:
+    - workers: Number of worker processes; 0 keeps processing on the event loop thread
+    - calibration_config: The `calibration` section of the config, loaded once per process
+    """
+
+    def __init__(self, workers=0, calibration_config=None):
+        self.workers = workers
+        self.calibration_config = calibration_config or {}
+        calibration_config = self.calibration_config
+        self._pools = [self.new_pool() for _ in range(workers)]
+        self.calibration = None
+        if self._pools:
+            logging.info(f"Started {workers} processing worker(s)")
+        else:
+            # Workers load their own copy in init_worker; only the in-process path needs one here
+            self.calibration = load_calibration(calibration_config.get("path"), calibration_config.get("default_total_capacity", 3000))
+            logging.info("Processing windows in-process")
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(self.calibration_config,))
+
+    def pool_index(self, siteid):
+        return zlib.crc32(str(siteid).encode('utf-8')) % len(self._pools)
+
+    def replace_pool(self, index, broken_pool):
+        # Concurrent windows on the same dead worker all see BrokenProcessPool; replace it only once
+        if self._pools[index] is broken_pool:
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            self._pools[index] = self.new_pool()
+            logging.warning(f"Processing worker {index} died, started a replacement")
+
+    async def process(self, df, refill_threshold, theft_threshold):
+        if not self._pools:
+            return await process_new_data(df, refill_threshold, theft_threshold, self.calibration)
+
+        shm, descriptor = pack_window(df)
+        try:
+            loop = asyncio.get_running_loop()
+            index = self.pool_index(df['siteid'].iloc[0])
+            for attempt in range(2):
+                pool = self._pools[index]
+                try:
+                    packed = await loop.run_in_executor(pool, run_window, descriptor, refill_threshold, theft_threshold)
+                    break
+                except BrokenProcessPool:
+                    self.replace_pool(index, pool)
+                    if attempt == 1:
+                        raise
+                    logging.warning(f"Retrying window for siteid {df['siteid'].iloc[0]} on the replacement worker")
+        finally:
+            shm.close()
+            shm.unlink()
+        return tuple(unpack_frame(frame) for frame in packed)
+
+    def shutdown(self):
+        for pool in self._pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self._pools = []
@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import json
+import random
+import asyncio
+import cProfile
+import logging
+import pstats
+import tracemalloc
+from datetime import datetime
+
+from src.logs import cleanup_old_logs
+
+
+def object_size(obj, seen=None, sample=100):
+    # Approximate deep size: DataFrames report their own deep usage, containers are walked.
+    # Containers longer than `sample` are estimated from evenly spaced elements, so the cost of
+    # a report stays bounded however many sites or packets are buffered.
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'columns'):
+        return int(obj.memory_usage(deep=True).sum())
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = sampled(list(obj.items()), sample)
+        size += scaled(sum(object_size(k, seen, sample) + object_size(v, seen, sample) for k, v in items), len(items), len(obj))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = sampled(obj if isinstance(obj, (list, tuple)) else list(obj), sample)
+        size += scaled(sum(object_size(item, seen, sample) for item in items), len(items), len(obj))
+    elif hasattr(obj, '__dict__'):
+        size += object_size(vars(obj), seen, sample)
+    return size
+
+
+def sampled(items, sample):
+    if len(items) <= sample:
+        return items
+    return items[::-(-len(items) // sample)]
+
+
+def scaled(measured, measured_count, total_count):
+    return int(measured * total_count / measured_count) if measured_count else 0
+
+
+class HandlerProfiler:
+    """
+    Opt-in profiler for async message handlers. A configurable fraction of handler calls runs
+    under cProfile; reports with the hottest functions, tracemalloc's top allocation sites and the
+    size of registered objects are written periodically to rotating files in `report_dir`.
+    Settings are re-read from the config file and SIGUSR1 toggles profiling, so no restart is needed.
+    Args:
+    - report_dir: Directory for profile reports
+    - settings: The `profiling` section of the config
+    """
+
+    def __init__(self, report_dir, settings=None):
+        self.report_dir = report_dir
+        self.settings = {}
+        self.enabled = False
+        self._stats = None
+        self._active = False
+        self._objects = {}
+        self.calls_total = 0
+        self.calls_sampled = 0
+        self.apply(settings or {})
+
+    def apply(self, settings):
+        self.settings = dict(settings)
+        enabled = bool(settings.get("enabled", False))
+        use_tracemalloc = enabled and settings.get("tracemalloc", True)
+
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(settings.get("tracemalloc_frames", 1))
+        elif not use_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        if enabled != self.enabled:
+            logging.info(f"Handler profiling {'enabled' if enabled else 'disabled'} "
+                         f"(sample rate {settings.get('sample_rate', 0.05)}, reports in {self.report_dir})")
+        self.enabled = enabled
+
+    def toggle(self):
+        self.apply({**self.settings, "enabled": not self.enabled})
+
+    def register_object(self, name, getter):
+        # getter is called at report time so reassigned globals are picked up
+        self._objects[name] = getter
+
+    def wrap(self, handler):
+        async def profiled_handler(*args, **kwargs):
+            self.calls_total += 1
+            # One profile at a time: other tasks interleaving on the loop land in the active one
+            if not self.enabled or self._active or random.random() >= self.settings.get("sample_rate", 0.05):
+                return await handler(*args, **kwargs)
+
+            profile = cProfile.Profile()
+            self._active = True
+            profile.enable()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._active = False
+                self.calls_sampled += 1
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+        return profiled_handler
+
+    def build_report(self):
+        top_n = self.settings.get("top_n", 25)
+        out = io.StringIO()
+        out.write(f"Profile report {datetime.now():%Y-%m-%d %H:%M:%S}\n")
+        out.write(f"Sampled {self.calls_sampled} of {self.calls_total} handler calls\n\n")
+
+        if self._stats is not None:
+            self._stats.stream = out
+            self._stats.sort_stats("cumulative").print_stats(top_n)
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            out.write(f"\nTraced memory: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n")
+            out.write(f"Top {top_n} allocation sites:\n")
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:top_n]:
+                out.write(f"  {stat}\n")
+
+        if self._objects:
+            out.write("\nTracked objects:\n")
+            for name, getter in self._objects.items():
+                try:
+                    out.write(f"  {name}: ~{object_size(getter()) / 1024:.1f} KiB (sampled estimate)\n")
+                except Exception as e:
+                    out.write(f"  {name}: size unavailable ({e})\n")
+        return out.getvalue()
+
+    def write_report(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        report_path = os.path.join(self.report_dir, f"profile_{datetime.now():%Y-%m-%d_%H-%M-%S}.txt")
+        with open(report_path, "w") as f:
+            f.write(self.build_report())
+        cleanup_old_logs(self.report_dir, max_files=self.settings.get("max_reports", 10), suffix=".txt")
+        logging.info(f"Profile report written to {report_path}")
+
+        self._stats = None
+        self.calls_total = 0
+        self.calls_sampled = 0
+
+    def install_signal_handler(self, signum=None):
+        import signal
+        try:
+            asyncio.get_running_loop().add_signal_handler(signum or signal.SIGUSR1, self.toggle)
+        except (NotImplementedError, AttributeError, RuntimeError) as e:
+            logging.warning(f"Profiling signal handler not installed: {e}")
+
+    async def run(self, config_path=None):
+        # Writes reports while enabled and picks up changes to the `profiling` config section
+        last_mtime = os.path.getmtime(config_path) if config_path else None
+        last_report = asyncio.get_running_loop().time()
+        while True:
+            await asyncio.sleep(self.settings.get("reload_interval", 10))
+
+            if config_path:
+                try:
+                    mtime = os.path.getmtime(config_path)
+                    if mtime != last_mtime:
+                        last_mtime = mtime
+                        with open(config_path, "r") as f:
+                            self.apply(json.load(f).get("profiling", {}))
+                except Exception as e:
+                    logging.error(f"Error reloading profiling settings from {config_path}: {e}")
+
+            now = asyncio.get_running_loop().time()
+            if now - last_report >= self.settings.get("report_interval", 300):
+                last_report = now
+                if self.enabled:
+                    try:
+                        self.write_report()
+                    except Exception as e:
+                        logging.error(f"Error writing profile report: {e}")
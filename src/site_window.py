@@ -0,0 +1,83 @@
+import bisect
+import logging
+
+
+class SiteWindowBuffer:
+    """
+    Per-site packet windows kept sorted by updatetime, with duplicate (siteid, updatetime) dropped.
+    Args:
+    - mode: 'count' keeps the newest `max_packets` packets, 'time' keeps packets within `span_seconds` of the newest
+    - max_packets: Window length in count mode
+    - span_seconds: Window span in time mode
+    """
+
+    def __init__(self, mode='count', max_packets=60, span_seconds=3600):
+        if mode not in ('count', 'time'):
+            raise ValueError(f"Unknown window mode '{mode}', expected 'count' or 'time'")
+        self.mode = mode
+        self.max_packets = max_packets
+        self.span_seconds = span_seconds
+        self._times = {}  # siteid -> sorted updatetimes, the index used for ordering and dedup
+        self._packets = {}  # siteid -> packets in the same order as _times
+
+    def add(self, packet):
+        """
+        Insert a packet in updatetime order. Returns False if it was a duplicate or falls outside the window.
+        """
+        siteid = packet['siteid']
+        updatetime = packet['updatetime']
+        times = self._times.setdefault(siteid, [])
+        packets = self._packets.setdefault(siteid, [])
+
+        position = bisect.bisect_left(times, updatetime)
+        if position < len(times) and times[position] == updatetime:
+            logging.info(f"Dropped duplicate packet with updatetime {updatetime} for siteid: {siteid}")
+            return False
+
+        if self.mode == 'count':
+            if len(times) >= self.max_packets and position == 0:
+                logging.info(f"Dropped late packet with updatetime {updatetime} older than the window for siteid: {siteid}")
+                return False
+        elif times and updatetime < times[-1] - self.span_seconds:
+            logging.info(f"Dropped late packet with updatetime {updatetime} older than the window for siteid: {siteid}")
+            return False
+
+        times.insert(position, updatetime)
+        packets.insert(position, packet)
+        self._evict(siteid)
+        return True
+
+    def _evict(self, siteid):
+        times = self._times[siteid]
+        packets = self._packets[siteid]
+        if self.mode == 'count':
+            excess = len(times) - self.max_packets
+        else:
+            excess = bisect.bisect_left(times, times[-1] - self.span_seconds)
+        if excess > 0:
+            logging.info(f"Removed {excess} oldest packet(s) up to updatetime {times[excess - 1]} for siteid: {siteid}")
+            del times[:excess]
+            del packets[:excess]
+
+    def is_complete(self, siteid):
+        times = self._times.get(siteid)
+        if not times:
+            return False
+        if self.mode == 'count':
+            return len(times) == self.max_packets
+        if len(times) < 2:
+            return False
+        # Eviction keeps at most span_seconds of data, so the retained packets count as covering the
+        # span once they reach it within one average sampling interval; a site resuming after a gap
+        # starts over from its first new packet
+        covered = times[-1] - times[0]
+        return covered + covered / (len(times) - 1) >= self.span_seconds
+
+    def window(self, siteid):
+        return list(self._packets.get(siteid, []))
+
+    def __len__(self):
+        return len(self._packets)
+
+    def __contains__(self, siteid):
+        return siteid in self._packets
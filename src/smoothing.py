@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Above this many window elements (n_samples * window) the O(n * w) sliding-window median
+# loses to pandas' O(n log w) skiplist, run once over all channels instead
+SLIDING_WINDOW_LIMIT = 250000
+
+
+def centered_rolling_median(values, window):
+    """
+    NaN-aware centered rolling median over axis 0, matching pandas
+    `rolling(window, center=True, min_periods=1).median()` column by column.
+    Args:
+    - values: Float array of shape (n_samples, n_channels)
+    - window: Window length in samples
+    """
+    if values.shape[0] * window > SLIDING_WINDOW_LIMIT:
+        return pd.DataFrame(values).rolling(window=window, center=True, min_periods=1).median().to_numpy()
+
+    # pandas centers a window of length w on row i as [i - w // 2, i + (w - 1) // 2]
+    padded = np.pad(values, ((window // 2, (window - 1) // 2), (0, 0)), constant_values=np.nan)
+    windows = sliding_window_view(padded, window, axis=0)  # (n_samples, n_channels, window), no copy
+
+    # Valid-sample count per window from a running sum, so full windows can skip NaN handling
+    valid = np.cumsum(~np.isnan(padded), axis=0)
+    valid = np.vstack([np.zeros((1, values.shape[1]), dtype=valid.dtype), valid])
+    counts = valid[window:] - valid[:-window]
+
+    median = np.full(values.shape, np.nan)
+    full = counts == window
+    if full.any():
+        median[full] = np.median(windows[full], axis=-1)
+
+    partial = ~full & (counts > 0)
+    if partial.any():
+        # Edge rows and windows with gaps: sort so NaNs go last, then pick the middle of the valid prefix
+        ordered = np.sort(windows[partial], axis=-1)
+        n_valid = counts[partial]
+        lower = np.take_along_axis(ordered, ((n_valid - 1) // 2)[:, None], axis=-1)[:, 0]
+        upper = np.take_along_axis(ordered, (n_valid // 2)[:, None], axis=-1)[:, 0]
+        median[partial] = (lower + upper) / 2
+    return median
+
+
+def interpolate_gaps(values):
+    # Linear interpolation by position; np.interp holds the end values, which is the
+    # same as pandas interpolate followed by ffill and bfill
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    values = values.copy()
+    positions = np.arange(values.shape[0])
+    for channel in range(values.shape[1]):
+        gaps = missing[:, channel]
+        if gaps.any() and not gaps.all():
+            values[gaps, channel] = np.interp(positions[gaps], positions[~gaps], values[~gaps, channel])
+    return values
+
+
+def smooth_fuel_levels(values, window):
+    """
+    Median, gap interpolation and second median for one site's fuel channels in a single pass.
+    Args:
+    - values: Float array of shape (n_samples, n_channels), in the site's row order
+    - window: Rolling median window length in samples
+    """
+    smoothed = centered_rolling_median(values, window)
+    smoothed = interpolate_gaps(smoothed)
+    smoothed = centered_rolling_median(smoothed, window)
+    # Anything still missing falls back to the raw reading
+    return np.where(np.isnan(smoothed), values, smoothed)